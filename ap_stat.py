@@ -1,4 +1,90 @@
-import matplotlib.pyplot as plt
+import functools
+import hashlib
+import weakref
+from collections import namedtuple
+from itertools import chain, repeat
+from types import SimpleNamespace
+
+import numpy as np
+
+# the most stacks we'll compare every observation against at once; the
+# comparison builds a len(data) by num_stacks table of booleans
+_MAX_COMPARE_STACKS = 32
+
+# the most observations we'll compare against every key at once. beyond a few
+# thousand observations, building that table costs more than the lookup table
+# in _build_lut, even for a handful of keys.
+_MAX_COMPARE_SIZE = 2000
+
+# the fewest observations worth handing to a compiled numba helper; below
+# this, numpy is already fast and compiling would cost far more than it saves
+_MIN_COMPILED_SIZE = 100000
+
+# the fewest observations worth splitting across threads to count the stacks.
+# the first parallel count in a session spends about 0.4 s importing numba and
+# loading the compiled kernel, and only from about this size does the kernel
+# win that back on its first call, even on a single core.
+_MIN_PARALLEL_SIZE = 20000000
+
+@functools.lru_cache(maxsize=None)
+def _get_numba():
+    """Compiles the numba helpers the first time they're needed.
+
+    numba is optional and slow to import, so rather than importing it along
+    with ap_stat, we wait until one of these helpers is about to be used.
+
+    ================================================================================
+    Returns
+    -------
+    A namespace holding the compiled helpers (bin_scan and
+    parallel_stack_counts) and numba's get_num_threads, or None if numba
+    isn't installed.
+    ================================================================================
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    @numba.njit(cache=True)
+    def _bin_scan(data, keys, idx):
+        # for a handful of keys, scanning them in order beats a binary search
+        # once the interpreter isn't in the way. observations before the first
+        # key go on the first stack, past the final key on the final stack.
+        for i in range(data.shape[0]):
+            x = data[i]
+            j = 0
+            for t in range(1, keys.shape[0]):
+                if x < keys[t]:
+                    break
+                j = t
+            idx[i] = j
+        return idx
+
+    @numba.njit(parallel=True, cache=True)
+    def _parallel_stack_counts(data, keys, lower_bound, scale, num_chunks):
+        # each thread counts the stacks for its own chunk of the data, then we
+        # add the chunks' counts together. the stacks are found the same way
+        # as in _get_stack_indices for evenly-spaced keys.
+        n = data.shape[0]
+        last = keys.shape[0] - 1
+        chunk_size = (n + num_chunks - 1) // num_chunks
+        counts = np.zeros((num_chunks, keys.shape[0]), np.intp)
+        for c in numba.prange(num_chunks):
+            for i in range(c * chunk_size, min((c + 1) * chunk_size, n)):
+                x = data[i]
+                j = int((x - lower_bound) * scale)
+                j = min(max(j, 0), last)
+                while j > 0 and x < keys[j]:
+                    j -= 1
+                while j < last and x >= keys[j + 1]:
+                    j += 1
+                counts[c, j] += 1
+        return counts.sum(axis=0)
+
+    return SimpleNamespace(bin_scan=_bin_scan,
+                           parallel_stack_counts=_parallel_stack_counts,
+                           get_num_threads=numba.get_num_threads)
 
 def get_stack_keys(data, num_stacks=5):
     """Creates a list containing the values where we will build our stacks.
@@ -24,11 +110,184 @@ def get_stack_keys(data, num_stacks=5):
     A list of real values where we want to place our stacks.
     ================================================================================
     """
-    upper_bound = max(data)
-    lower_bound = min(data)
-    stack_keys = [lower_bound + i * (upper_bound - lower_bound) / (num_stacks-1)
-              for i in range(num_stacks)]
-    return stack_keys
+    data = np.asarray(data, dtype=np.float64)
+    return _get_stack_keys(*_get_bounds(data), num_stacks).tolist()
+
+def _get_bounds(data):
+    """Finds the minimum and maximum of an array of observations."""
+    return data.min(), data.max()
+
+def _get_stack_keys(lower_bound, upper_bound, num_stacks):
+    """Spaces num_stacks stack_keys evenly from lower_bound to upper_bound.
+
+    Split out of get_stack_keys so callers that already know the minimum and
+    maximum of the data don't have to look for them again.
+    """
+    # this is np.linspace(lower_bound, upper_bound, num_stacks), but computed as
+    # lower_bound + i * range / (num_stacks - 1): linspace multiplies by a
+    # precomputed step instead, which can nudge a key by a rounding error and
+    # move observations sitting right on that key onto the stack to its left.
+    return lower_bound + np.arange(num_stacks) * (upper_bound - lower_bound) / (num_stacks-1)
+
+def _get_scale(lower_bound, upper_bound, num_stacks):
+    """Finds the factor that rescales evenly-spaced stacks onto 0, 1, 2, ...
+
+    If every observation is the same there's nothing to rescale, so we use 0.
+    """
+    if upper_bound > lower_bound:
+        return (num_stacks - 1) / (upper_bound - lower_bound)
+    return 0.0
+
+def _build_lut(keys, oversample=4):
+    """Builds a lookup table from an evenly-spaced grid to the stack_keys.
+
+    The grid runs from keys[0] to keys[-1] with oversample slots for every gap
+    between keys, and lut[j] is the index of the stack that slot j starts on.
+    An observation's slot can then be computed directly, the same way we
+    handle evenly-spaced keys.
+
+    ================================================================================
+    Parameters
+    ----------
+        keys (numpy array):
+            The sorted stack_keys.
+        oversample (int):
+            The number of grid slots per gap between keys. Default value is 4.
+
+    Returns
+    -------
+    A tuple (grid_min, grid_step, lut) describing the grid and its lookup table.
+    ================================================================================
+    """
+    num_slots = oversample * (len(keys) - 1)
+    grid_min = keys[0]
+    grid_step = (keys[-1] - keys[0]) / num_slots if num_slots > 0 else 0.0
+    grid = grid_min + grid_step * np.arange(num_slots + 1)
+    lut = np.searchsorted(keys, grid, side='right') - 1
+    np.clip(lut, 0, len(keys) - 1, out=lut)
+    return grid_min, grid_step, lut.astype(_get_index_dtype(len(keys)))
+
+def _get_index_dtype(num_stacks):
+    """Picks the smallest unsigned integer type that can number the stacks.
+
+    Stack indices get read over and over (fixing, sorting and counting them),
+    so storing each in one or two bytes instead of eight cuts down the memory
+    traffic. The type can hold num_stacks itself, so idx + 1 never overflows.
+    """
+    return np.min_scalar_type(num_stacks)
+
+def _fix_stack_indices(data, keys, idx):
+    """Nudges stack indices until each observation sits on the right stack.
+
+    Each observation should land on the last key that is not greater than it
+    (or the first key, if it is smaller than all of them). idx is updated in
+    place; it only needs to be close, since most observations will already be
+    on the right stack.
+
+    ================================================================================
+    Parameters
+    ----------
+        data (numpy array):
+            The observations.
+        keys (numpy array):
+            The sorted stack_keys.
+        idx (numpy array):
+            A first guess at the index of the stack for each observation.
+
+    Returns
+    -------
+    idx, after it has been corrected.
+    ================================================================================
+    """
+    last = len(keys) - 1
+    while True:
+        too_high = (idx > 0) & (data < keys[idx])
+        too_low = (idx < last) & (data >= keys[np.minimum(idx + 1, last)])
+        if not (too_high.any() or too_low.any()):
+            return idx
+        idx[too_high] -= 1
+        idx[too_low] += 1
+
+def _get_stack_indices(data, num_stacks=5, keys=None):
+    """Finds the index of the stack each observation belongs on.
+
+    ================================================================================
+    Parameters
+    ----------
+        data (list-like):
+            A list of real numbers. This is the raw data we are exploring.
+        num_stacks (int):
+            The number of stacks we want to build on our dotplot.
+        keys (list-like):
+            Particular values to use for the keys, or None to space num_stacks
+            keys evenly between the minimum and maximum of data.
+
+    Returns
+    -------
+    A tuple (data, keys, idx), where data and keys are the observations and the
+    stack_keys as numpy arrays, and idx[n] is the index into keys of the stack
+    that data[n] falls on (stored in the smallest unsigned integer type that
+    fits, see _get_index_dtype).
+    ================================================================================
+    """
+    data = np.asarray(data, dtype=np.float64)
+
+    if keys is None:
+        lower_bound, upper_bound = _get_bounds(data)
+        keys = _get_stack_keys(lower_bound, upper_bound, num_stacks)
+
+        # the stacks are evenly spaced, so instead of searching for the right
+        # stack we can compute it directly: rescale each observation so the
+        # stacks sit on 0, 1, 2, ..., and round down to the stack on the left.
+        idx = data - lower_bound
+        idx *= _get_scale(lower_bound, upper_bound, num_stacks)
+        np.floor(idx, out=idx)
+
+        # the maximum lands exactly on the final stack, everything else is
+        # already in range, so there's no special case for the last stack: we
+        # just clip, which also catches any floating-point roundoff.
+        np.clip(idx, 0, num_stacks - 1, out=idx)
+        idx = idx.astype(_get_index_dtype(num_stacks))
+
+        # the rescaling can be off by one for observations sitting right on a
+        # key, so check against the keys themselves (this is what numpy does
+        # for np.histogram with uniform bins).
+        _fix_stack_indices(data, keys, idx)
+    else:
+        # the keys might not be evenly spaced, so we can't compute the stacks
+        # directly. observations past the final key belong on the final stack,
+        # and any observations before the first key go on the first stack.
+        keys = np.ascontiguousarray(keys, dtype=np.float64)
+        small = len(keys) <= _MAX_COMPARE_STACKS
+        kernels = _get_numba() if small and len(data) >= _MIN_COMPILED_SIZE else None
+        if kernels is not None:
+            # for a handful of keys and lots of data, a compiled scan of the
+            # keys is hard to beat. (with many keys, scanning every one is
+            # slower than the lookup table below.)
+            idx = np.empty(len(data), dtype=_get_index_dtype(len(keys)))
+            kernels.bin_scan(data, keys, idx)
+        elif small and len(data) <= _MAX_COMPARE_SIZE:
+            # for a small dataset, do the same scan all at once: compare every
+            # observation against every key and count the keys it has passed.
+            idx = np.count_nonzero(data[:, None] >= keys[None, :], axis=1) - 1
+            np.clip(idx, 0, len(keys) - 1, out=idx)
+            idx = idx.astype(_get_index_dtype(len(keys)))
+        else:
+            # lay a finer, evenly-spaced grid over the keys and look up which
+            # stack each grid slot starts on. that gets every observation to
+            # its stack (or a neighbouring one) without searching, and
+            # comparing against the keys finishes the job.
+            grid_min, grid_step, lut = _build_lut(keys)
+            if grid_step > 0:
+                slot = np.clip((data - grid_min) / grid_step, 0, len(lut) - 1).astype(np.intp)
+                idx = lut[slot]
+                _fix_stack_indices(data, keys, idx)
+            else:
+                idx = np.searchsorted(keys, data, side='right') - 1
+                np.clip(idx, 0, len(keys) - 1, out=idx)
+                idx = idx.astype(_get_index_dtype(len(keys)))
+
+    return data, keys, idx
 
 def get_stack_dict(data, num_stacks=5, keys=None):
     """Assigns each observation to the appropriate stack.
@@ -54,36 +313,28 @@ def get_stack_dict(data, num_stacks=5, keys=None):
     each key is a list of observations that fall on that stack.
     ================================================================================
     """
-    if keys == None:
-        keys = get_stack_keys(data=data, num_stacks=num_stacks)
-    stack_dict = {key:[] for key in keys}
-
-    for observation in data:
-        # a flag variable, indicating we need to add our value to the final
-        # stack. by default, we assume we'll have to do this.
-        add_to_end = True
-
-        # step through the list, when observation is between two entries, add
-        # it to the list corresponding to the key on the left. since we're
-        # comparing two adjacent list entries, we'll need to iterate over the
-        # index.
-        for i in range(1, len(keys)):
-            # if the observation is between these two keys
-            if keys[i-1] <= observation < keys[i]:
-                # add it to the lower key's list of values
-                stack_dict[keys[i-1]].append(observation)
-
-                # we don't need to add it to the end of the list
-                add_to_end = False
-
-                # we don't need to continue looking for the right key
-                break
-
-        # if we make it to the end of the list without finding the key to the
-        # left of the value of the observation, that means we need to add it
-        # to the final stack
-        if add_to_end:
-            stack_dict[keys[-1]].append(observation)
+    # the binning works on float copies of the data and keys, but the stacks
+    # should hold the observations exactly as they were given to us (so ints
+    # stay ints), and user-supplied keys should stay as they were too.
+    observations = np.asarray(data, dtype=object)
+    key_values = None if keys is None else list(keys)
+
+    _, keys, idx = _get_stack_indices(data, num_stacks, keys)
+    if key_values is None:
+        key_values = keys.tolist()
+
+    # sort the observations by stack (stable, so each stack keeps the original
+    # order of its observations). counting the observations on each stack
+    # tells us where each stack starts and ends in the sorted list, so every
+    # stack's list is sliced out at its final size instead of grown by append.
+    counts = np.bincount(idx, minlength=len(keys)).tolist()
+    ends = np.cumsum(counts).tolist()
+    sorted_observations = observations[np.argsort(idx, kind='stable')].tolist()
+
+    # (if a key is repeated, every observation goes on its last copy, which is
+    # also the copy that ends up in the dictionary.)
+    stack_dict = {key: sorted_observations[end - count:end]
+                  for key, count, end in zip(key_values, counts, ends)}
 
     return stack_dict
 
@@ -108,21 +359,179 @@ def get_points(stack_dict):
     ================================================================================
     """
 
-    # the list to hold the points
-    ordered_pairs = []
+    # for each stack, pair its key with the heights 1, 2, ..., one for each
+    # observation on the stack, then chain the stacks together. zip builds the
+    # ordered pairs for us, so there's no Python loop over individual points.
+    ordered_pairs = list(chain.from_iterable(
+        zip(repeat(key), range(1, len(observations) + 1))
+        for key, observations in stack_dict.items()))
 
-    # iterate over the items in the list
-    for key, observations in stack_dict.items():
+    return ordered_pairs
 
-        # add a point onto the stack for each value in this list
-        for i, obs in enumerate(observations):
-            ordered_pairs.append((key, i+1))
+def get_points_xy(stack_dict):
+    """Generates the x- and y-values for the scatterplot based on the stack_dict.
 
-    return ordered_pairs
+    Places the same points as get_points, but instead of a list of ordered pairs
+    it returns the x-values and the y-values as two separate numpy arrays, which
+    is the form matplotlib wants them in anyway.
+
+    ================================================================================
+    Parameters
+    ----------
+        stack_dict (dict):
+            a dictionary whose keys are the desired x-values for the dotplot,
+            and whose values are the observations falling on that stack.
+
+    Returns
+    -------
+    A tuple (xs, ys) of numpy arrays, where (xs[i], ys[i]) is a point for the
+    scatterplot to mimic a dotplot.
+    ================================================================================
+    """
+    keys = np.fromiter(stack_dict.keys(), dtype=np.float64, count=len(stack_dict))
+    counts = np.fromiter((len(observations) for observations in stack_dict.values()),
+                         dtype=np.intp, count=len(stack_dict))
+    return _stack_xy(keys, counts)
 
-import matplotlib.pyplot as plt
+def _compute_dot_xy(data, num_stacks=5, keys=None):
+    """Computes the coordinates of the dots without building a stack_dict.
+
+    This does the same job as get_stack_dict followed by get_points, but the
+    dotplot only needs to know how tall each stack is, so we count the
+    observations on each stack and build the x- and y-values straight from the
+    counts.
+
+    ================================================================================
+    Parameters
+    ----------
+        data (list-like):
+            A list of real numbers. This is the raw data we are exploring.
+        num_stacks (int):
+            The number of stacks we want to build on our dotplot.
+        keys (list-like):
+            Particular values to use for the keys, or None to space num_stacks
+            keys evenly between the minimum and maximum of data.
 
-def dotplot(data, num_stacks=5, keys=None, rotation=None, filename='image.png', show=False):
+    Returns
+    -------
+    A tuple (keys, counts, xs, ys) of numpy arrays: the stack_keys, the number
+    of observations on each stack, and the coordinates of every dot.
+    ================================================================================
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if keys is not None:
+        keys = tuple(np.asarray(keys, dtype=np.float64).tolist())
+    keys, counts = _get_stack_counts(_DataKey(data), num_stacks, keys)
+    xs, ys = _stack_xy(keys, counts)
+    return keys, counts, xs, ys
+
+class _DataKey:
+    """A hashable stand-in for an array of observations.
+
+    Two _DataKeys are equal when their observations are, judged by a blake2b
+    digest of the array's bytes, which means reading all of the data once. Only a weak reference to the array is kept, so caching a
+    _DataKey doesn't keep the data itself alive.
+    """
+    __slots__ = ('digest', 'data')
+
+    def __init__(self, data):
+        self.digest = (data.shape, hashlib.blake2b(np.ascontiguousarray(data)).digest())
+        self.data = weakref.ref(data)
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __eq__(self, other):
+        return self.digest == other.digest
+
+@functools.lru_cache(maxsize=16)
+def _get_stack_counts(data_key, num_stacks, keys):
+    """Counts the observations on each stack, remembering recent answers.
+
+    Redrawing the same data (say, while trying out different options in a
+    notebook) then skips the binning. Only the keys and the counts are kept,
+    so the cache stays small however large the data is.
+
+    The cache can't tell the data is the same without reading all of it, so
+    every call still hashes the whole array with blake2b (see _DataKey). That
+    takes roughly half as long as binning the data, so a cache hit saves about
+    half the work, not all of it.
+
+    ================================================================================
+    Parameters
+    ----------
+        data_key (_DataKey):
+            The observations, wrapped so they can be used as part of a cache key.
+        num_stacks (int):
+            The number of stacks we want to build on our dotplot.
+        keys (tuple):
+            Particular values to use for the keys, or None to space num_stacks
+            keys evenly between the minimum and maximum of data.
+
+    Returns
+    -------
+    A tuple (keys, counts) of read-only numpy arrays, where counts[k] is the
+    number of observations on the stack at keys[k].
+    ================================================================================
+    """
+    data = data_key.data()
+    kernels = _get_numba() if len(data) >= _MIN_PARALLEL_SIZE else None
+    if keys is None and kernels is not None:
+        # lots of data on evenly-spaced stacks: count them across all threads
+        lower_bound, upper_bound = _get_bounds(data)
+        keys = _get_stack_keys(lower_bound, upper_bound, num_stacks)
+        scale = _get_scale(lower_bound, upper_bound, num_stacks)
+        counts = kernels.parallel_stack_counts(data, keys, lower_bound, scale,
+                                               kernels.get_num_threads())
+    else:
+        _, keys, idx = _get_stack_indices(data, num_stacks, keys)
+        counts = np.bincount(idx, minlength=len(keys))
+
+    # a repeated key is really just one stack (for instance, when every
+    # observation is the same, all the evenly-spaced keys are equal), so keep
+    # one copy of it. observations always go on the last copy of a key, so
+    # that's the one to keep, just like get_stack_dict's dictionary does.
+    last_copy = np.append(keys[1:] != keys[:-1], True)
+    keys, counts = keys[last_copy], counts[last_copy]
+
+    # the same arrays are handed to every caller with this data, so make sure
+    # none of them can change the cached copy
+    keys.setflags(write=False)
+    counts.setflags(write=False)
+    return keys, counts
+
+def _stack_xy(keys, counts):
+    """Lays out counts[k] dots over keys[k], returning the arrays xs and ys."""
+    # each key is repeated once per dot on its stack...
+    xs = np.repeat(keys, counts)
+
+    # ...and the dots on each stack are numbered 1, 2, ..., counts[k]: number
+    # every dot in order, then subtract the number of dots on earlier stacks.
+    starts = np.cumsum(counts) - counts
+    ys = np.arange(1, counts.sum() + 1) - np.repeat(starts, counts)
+
+    return xs, ys
+
+_Style = namedtuple('_Style', ['markersize', 'fontsize'])
+
+@functools.lru_cache(maxsize=32)
+def _get_style(num_stacks, num_keys):
+    """Sizes the dots and tick labels for a dotplot with the given stacks.
+
+    Fewer stacks leave more room, so the dots and labels grow to fill it. The
+    dot size depends on the number of keys and the label size on num_stacks,
+    so they're worked out once and remembered for dotplots of the same shape.
+    The result is a (read-only) _Style, since every caller shares it.
+    """
+    return _Style(
+        # markersize is a diameter in points; this gives the same dots as a
+        # scatterplot with s=4000/num_keys (an area in points squared)
+        markersize=np.sqrt(4000/num_keys),
+        fontsize=200/num_stacks,
+    )
+
+def dotplot(data, num_stacks=5, keys=None, rotation=None, filename='image.png', show=False,
+            ax=None):
     """Function to create the dotplot and save it to a file.
 
     This function provides a minimal interface for creating a dotplot with
@@ -159,48 +568,56 @@ def dotplot(data, num_stacks=5, keys=None, rotation=None, filename='image.png',
             Whether or not to call plt.show(). If in a notebook, set show=True
             to show the dotplot inline.
             Default: False
+        ax (matplotlib Axes):
+            Axes to draw the dotplot on. They are cleared first, so when making
+            many dotplots in a row, passing the same Axes each time saves
+            building a new figure for every plot.
+            Default: None (a new 15x7 figure is created)
 
     Returns
     -------
     None
     ================================================================================
     """
-
-    # create the stack_dict
-    stack_dict = get_stack_dict(data, num_stacks, keys)
-
-    # get the keys (will return a list containing the same values if keys=None)
-    keys = list(stack_dict.keys())
-
-    # get the list of points
-    points = get_points(stack_dict)
-
-    # split the ordered pairs into x-values and y-values to make matplotlib happy
-    xs = [x for x, _ in points]
-    ys = [y for _, y in points]
-
-    # create the figure
-    plt.figure(figsize=(15,7))
-
-    # plot the scatterplot
-    plt.scatter(xs, ys, s=4000/len(keys))
+    # importing pyplot sets up matplotlib's backend, which is slow, so only do
+    # it once we're actually drawing something
+    import matplotlib.pyplot as plt
+
+    # get the keys, the height of each stack, and the coordinates of every dot
+    # (the keys will be the same values get_stack_keys returns if keys=None)
+    keys, counts, xs, ys = _compute_dot_xy(data, num_stacks, keys)
+
+    # create the figure, or wipe the axes we were given
+    if ax is None:
+        _, ax = plt.subplots(figsize=(15,7))
+    else:
+        ax.clear()
+
+    # plot the dots. every dot looks the same, so we draw them as the markers
+    # of a single line with no line, which matplotlib renders much faster than
+    # a scatterplot.
+    style = _get_style(num_stacks, len(keys))
+    ax.plot(xs, ys, marker='o', linestyle='None',
+            markersize=style.markersize, markeredgewidth=0)
 
     # turn off the y-axis
-    plt.gca().get_yaxis().set_visible(False)
+    ax.get_yaxis().set_visible(False)
 
     # set the x-ticks
-    plt.xticks(list(stack_dict.keys()), fontsize=200/num_stacks, rotation=rotation)
+    ax.set_xticks(keys)
+    for label in ax.get_xticklabels():
+        label.set(fontsize=style.fontsize, rotation=rotation)
 
-    # set the vertical limits
-    plt.ylim(0, 1.1 * max(ys))
+    # set the vertical limits (the tallest stack is the highest dot)
+    ax.set_ylim(0, 1.1 * counts.max())
 
     # hide the box around the axis
-    plt.gca().spines['top'].set_visible(False)
-    plt.gca().spines['left'].set_visible(False)
-    plt.gca().spines['right'].set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.spines['left'].set_visible(False)
+    ax.spines['right'].set_visible(False)
 
     # save the file
-    plt.savefig(filename)
+    ax.figure.savefig(filename)
 
     # show the figure, if possible
     if show:
@@ -0,0 +1,143 @@
+import random
+
+import numpy as np
+import pytest
+
+import ap_stat
+
+def loop_stack_dict(data, keys):
+    """The original get_stack_dict: place each observation by scanning the keys."""
+    stack_dict = {key:[] for key in keys}
+    for observation in data:
+        add_to_end = True
+        for i in range(1, len(keys)):
+            if keys[i-1] <= observation < keys[i]:
+                stack_dict[keys[i-1]].append(observation)
+                add_to_end = False
+                break
+        if add_to_end:
+            stack_dict[keys[-1]].append(observation)
+    return stack_dict
+
+def random_cases(num_keys, num_cases=50):
+    """Random data and sorted keys, with plenty of observations sitting on keys.
+
+    The data never goes below the first key, since the original loop put those
+    observations on the final stack rather than the first.
+    """
+    rng = random.Random(num_keys)
+    for _ in range(num_cases):
+        keys = sorted(rng.sample([x / 2 for x in range(4 * num_keys)], num_keys))
+        data = [rng.choice([rng.choice(keys), round(rng.uniform(keys[0], keys[-1] + 2), 1)])
+                for _ in range(rng.randint(1, 200))]
+        yield data, keys
+
+@pytest.fixture
+def no_numba(monkeypatch):
+    monkeypatch.setattr(ap_stat, '_get_numba', lambda: None)
+
+def check_against_loop(num_keys):
+    for data, keys in random_cases(num_keys):
+        assert ap_stat.get_stack_dict(data, keys=keys) == loop_stack_dict(data, keys)
+
+def test_compiled_scan(monkeypatch):
+    pytest.importorskip('numba')
+    monkeypatch.setattr(ap_stat, '_MIN_COMPILED_SIZE', 0)
+    check_against_loop(num_keys=10)
+
+def test_broadcast_compare(no_numba):
+    check_against_loop(num_keys=10)
+
+def test_lookup_table(no_numba, monkeypatch):
+    monkeypatch.setattr(ap_stat, '_MAX_COMPARE_STACKS', 0)
+    check_against_loop(num_keys=10)
+    check_against_loop(num_keys=100)
+
+def test_searchsorted_for_repeated_keys(no_numba, monkeypatch):
+    monkeypatch.setattr(ap_stat, '_MAX_COMPARE_STACKS', 0)
+    data = [2, 2, 3, 5]
+    assert ap_stat.get_stack_dict(data, keys=[2, 2, 2]) == loop_stack_dict(data, [2, 2, 2])
+
+def test_evenly_spaced_keys():
+    assert ap_stat.get_stack_dict(data=[1,1,3,5,2], num_stacks=3) == {1.0:[1,1,2], 3.0:[3], 5.0:[5]}
+    for data, _ in random_cases(num_keys=10):
+        keys = ap_stat.get_stack_keys(data, num_stacks=7)
+        assert ap_stat.get_stack_dict(data, num_stacks=7) == loop_stack_dict(data, keys)
+
+def test_dotplot_points_for_equal_observations():
+    keys, counts, xs, ys = ap_stat._compute_dot_xy([9, 9, 9], num_stacks=5)
+    assert keys.tolist() == [9.0]
+    assert counts.tolist() == [3]
+    assert xs.tolist() == [9.0, 9.0, 9.0]
+    assert ys.tolist() == [1, 2, 3]
+
+def test_stacks_hold_the_original_observations():
+    stack_dict = ap_stat.get_stack_dict([1, 2, 2**53 + 1, 4], keys=[1, 3])
+    assert stack_dict == {1: [1, 2], 3: [2**53 + 1, 4]}
+    assert all(type(key) is int for key in stack_dict)
+    assert all(type(obs) is int for stack in stack_dict.values() for obs in stack)
+
+def test_get_points_xy_matches_get_points():
+    stack_dict = {1.0: [1, 1.4], 2.0: [2, 2], 3.0: [3, 3], 4.0: [], 7.0: [7]}
+    xs, ys = ap_stat.get_points_xy(stack_dict)
+    assert list(zip(xs.tolist(), ys.tolist())) == ap_stat.get_points(stack_dict)
+
+    xs, ys = ap_stat.get_points_xy({})
+    assert xs.tolist() == [] and ys.tolist() == []
+
+def test_stack_counts_are_cached():
+    ap_stat._get_stack_counts.cache_clear()
+    data = np.array([1.0, 2, 2, 3, 5])
+    ap_stat._compute_dot_xy(data, num_stacks=3)
+    ap_stat._compute_dot_xy(data.copy(), num_stacks=3)
+    assert ap_stat._get_stack_counts.cache_info().hits == 1
+
+def test_stack_counts_follow_changes_to_the_data():
+    data = np.array([1.0, 2, 2, 3, 5])
+    _, counts, _, _ = ap_stat._compute_dot_xy(data, num_stacks=3)
+    assert counts.tolist() == [3, 1, 1]
+    data[1:3] = 5
+    _, counts, _, _ = ap_stat._compute_dot_xy(data, num_stacks=3)
+    assert counts.tolist() == [1, 1, 3]
+
+def test_cached_stack_counts_are_read_only():
+    keys, counts, _, _ = ap_stat._compute_dot_xy([1, 2, 2, 3, 5], num_stacks=3)
+    with pytest.raises(ValueError):
+        counts[0] = 10
+    with pytest.raises(ValueError):
+        keys[0] = 10
+
+def test_dotplot_reuses_axes(tmp_path):
+    matplotlib = pytest.importorskip('matplotlib')
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    filename = str(tmp_path / 'dotplot.png')
+    ap_stat.dotplot([1, 2, 2, 3], num_stacks=3, rotation=45, filename=filename, ax=ax)
+    ap_stat.dotplot([5, 6, 6, 7, 7, 7], num_stacks=3, filename=filename, ax=ax)
+
+    # the first plot's dots are gone, and only the second plot's are left
+    assert len(ax.lines) == 1
+    assert ax.lines[0].get_xdata().tolist() == [5.0, 6.0, 6.0, 7.0, 7.0, 7.0]
+
+    # rotation=None puts the tick labels back upright
+    labels = ax.get_xticklabels()
+    assert labels and all(label.get_rotation() == 0 for label in labels)
+    assert (tmp_path / 'dotplot.png').exists()
+    plt.close(fig)
+
+def test_parallel_stack_counts(monkeypatch):
+    pytest.importorskip('numba')
+    monkeypatch.setattr(ap_stat, '_MIN_PARALLEL_SIZE', 0)
+    ap_stat._get_stack_counts.cache_clear()
+
+    # plenty of observations sitting right on the keys
+    rng = np.random.default_rng(0)
+    for data in [np.round(rng.normal(0, 5, 1000), 1), np.arange(25.0)]:
+        _, counts, _, _ = ap_stat._compute_dot_xy(data, num_stacks=6)
+        _, keys, idx = ap_stat._get_stack_indices(data, num_stacks=6)
+        assert counts.tolist() == np.bincount(idx, minlength=len(keys)).tolist()
+
+    keys, counts, _, _ = ap_stat._compute_dot_xy(np.full(10, 4.0), num_stacks=6)
+    assert keys.tolist() == [4.0] and counts.tolist() == [10]